@@ -1,8 +1,9 @@
 from __future__ import annotations
 from datetime import datetime
-from typing import Optional, Self
+from typing import Any, Optional, Self
 
-from sqlalchemy import DateTime, ForeignKey, Identity, Select, select
+from sqlalchemy import DateTime, ForeignKey, Identity, Index, Select, select
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -17,6 +18,7 @@ class Mail(Record):
     date: Mapped[datetime]
     text: Mapped[str]
     data: Mapped[bytes]
+    headers: Mapped[Optional[dict[str, Any]]] = mapped_column(JSONB)
 
     attachments: Mapped[list[Attachment]] = relationship(
         back_populates="mail",
@@ -55,7 +57,7 @@ class Attachment(Record):
     data: Mapped[bytes] = mapped_column(deferred_raiseload=True)
 
     def __repr__(self) -> str:
-        return f"Attachment<{self.mail.id}#{self.number}>"
+        return f"Attachment<{self.mail_id}#{self.number}>"
 
 
 class Consumer(Record):
@@ -74,6 +76,9 @@ class Consumer(Record):
 
 class Dispatch(Record):
     __tablename__ = "dispatch"
+    __table_args__ = (
+        Index("dispatch_consumer_next_time", "consumer_id", "next_time"),
+    )
 
     consumer_id: Mapped[int] = mapped_column(
         ForeignKey(Consumer.id), primary_key=True
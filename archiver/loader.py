@@ -1,21 +1,53 @@
 import contextlib
 import email.utils
+import os.path
+import re
+import threading
 from email.headerregistry import AddressHeader
+from email.message import EmailMessage, MIMEPart
 from email.parser import BytesParser
 from email.policy import default as DEFAULT_POLICY  # noqa: N812
-from typing import Optional
+from mimetypes import guess_all_extensions
+from typing import Any, Optional, cast
 
-from django_mailman3.lib.scrub import Scrubber  # type: ignore
 from magic import Magic, MagicException
+from pydantic_core import to_jsonable_python
 
 from archiver.database import Attachment, Mail
 from archiver.resource import Attachment as AttachmentResource
 from archiver.resource import Mail as MailResource
 from archiver.resource import Target
 
-MAGIC = Magic(mime=True, mime_encoding=True)
+# A libmagic handle isn't thread-safe (python-magic serializes access to it
+# with a lock) so each thread has its own. See magic().
+LOCAL = threading.local()
+
+# Unlike a libmagic handle this can be shared between threads: each call
+# creates its own FeedParser and the parser itself holds only the policy
 PARSER = BytesParser(policy=DEFAULT_POLICY)
 
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+# Magic numbers of common binary types that can be identified without libmagic.
+# ZIP isn't here as libmagic distinguishes formats that are ZIP archives (e.g.
+# OOXML, OpenDocument, and JAR).
+SIGNATURE = (
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"\x1f\x8b", "application/gzip"),
+)
+
+# Patterns to sanitize an attachment's filename (from Mailman's Scrubber)
+NAME_PATH = re.compile(r"[/\\:]")
+NAME_DROP = re.compile(r"[^-\w.]")
+NAME_HEAD = re.compile(r"^\.*")
+
+# A separator that Mailman inserts into a digest's text
+NEXT_PART = re.compile(r"--------------[ ]next[ ]part[ ]--------------\n")
+
 
 def load_mail_record(origin: bytes) -> Mail:
     """Create a Mail object from the RFC 5322 email message in *origin*."""
@@ -25,28 +57,48 @@ def load_mail_record(origin: bytes) -> Mail:
     id = email.utils.unquote(message["Message-ID"])
     date = message["Date"].datetime
 
-    text, attachments = Scrubber(message).scrub()
+    headers = to_jsonable_python(load_mail_headers(message))
+
+    text, attachments = scrub(message)
     text = text.strip()
 
-    mail = Mail(id=id, date=date, text=text, data=origin)
+    mail = Mail(id=id, date=date, text=text, data=origin, headers=headers)
 
     number: int
     name: str
     type: str
     code: Optional[str]
     data: bytes | str
-    for number, name, type, code, data in attachments:
+    for number, part, type in attachments:
+        name = load_attachment_name(part, type)
         attachment = Attachment(number=number, name=name)
 
+        # Decode the attachment only now that we're going to store it. A
+        # message/rfc822 part is multipart so it's stored as it's written.
+        if type == "message/rfc822":
+            data = part.get_content().as_bytes()
+        else:
+            data = cast(bytes, part.get_payload(decode=True))
+        code = part.get_content_charset()
+
+        # Decode a text part with its declared charset like get_content() so
+        # that libmagic only guesses the charset of a part without one
+        if type.startswith("text/") and code and isinstance(data, bytes):
+            try:
+                content = data.decode(code, "replace")
+            except LookupError:
+                content = data.decode("utf-8", "replace")
+            data = content
+
         if type in ("application/octet-stream", "text/plain"):
             type, code = estimate_type(data) or (type, code)
 
         if type.startswith("text/") and isinstance(data, bytes):
-            with contextlib.suppress(ValueError):
+            with contextlib.suppress(LookupError, ValueError):
                 data = data.decode(code or "utf-8")
 
         if isinstance(data, str):
-            data, code = data.encode(code or "utf-8"), "utf-8"
+            data, code = data.encode("utf-8"), "utf-8"
         attachment.data = data
 
         if type.startswith("text/") and code is not None:
@@ -58,82 +110,238 @@ def load_mail_record(origin: bytes) -> Mail:
     return mail
 
 
+def scrub(
+    message: EmailMessage,
+) -> tuple[str, list[tuple[int, MIMEPart, str]]]:
+    """Separate the text of *message* from its attachments.
+
+    This follows the rules of Mailman's Scrubber: each text/html part, each
+    message/rfc822 part, and each other non-multipart part that isn't inline
+    text/plain is an attachment, numbered by its position in a walk of
+    *message*. The text is the concatenation of each remaining text/plain
+    part. Unlike the Scrubber this doesn't modify *message* and doesn't decode
+    an attachment; each attachment is returned as its number, part, and type.
+    """
+
+    text: list[str] = []
+    attachments: list[tuple[int, MIMEPart, str]] = []
+
+    # Walk the message ourselves so that we don't descend into an attached
+    # message/rfc822 part
+    number = 0
+    stack: list[MIMEPart] = [message]
+    while stack:
+        part = stack.pop()
+        type = part.get_content_type()
+
+        if type == "text/plain" and not part.is_attachment():
+            text.append(load_text(part))
+        elif type in ("text/plain", "text/html", "message/rfc822"):
+            attachments.append((number, part, type))
+            # The Scrubber replaces each of these with an empty line
+            text.append("\n")
+        elif part.is_multipart():
+            stack.extend(reversed(list(part.iter_parts())))
+        elif part.get_payload():
+            attachments.append((number, part, type))
+
+        number += 1
+
+    return ("\n".join(text), attachments)
+
+
+def load_text(part: MIMEPart) -> str:
+    """Decode the text of the inline text/plain *part*."""
+
+    data = cast(Optional[bytes], part.get_payload(decode=True)) or b""
+
+    # Without a charset try UTF-8 and then ISO-8859-15 (which can't fail)
+    code = part.get_content_charset()
+    try:
+        text = data.decode(code or "utf-8")
+    except (LookupError, ValueError):
+        if code is not None:
+            text = data.decode("utf-8", "replace")
+        else:
+            text = data.decode("iso8859-15")
+
+    if (m := NEXT_PART.search(text)) is not None:
+        text = text[: m.start()]
+    text = text.replace("\x00", "")
+
+    return text if text.endswith("\n") else f"{text}\n"
+
+
+def load_attachment_name(part: MIMEPart, type: str) -> str:
+    """Create a sanitized filename for the attachment in *part*."""
+
+    try:
+        name = "".join(part.get_filename("").splitlines())
+    except (TypeError, UnicodeDecodeError):
+        name = "attachment.bin"
+
+    name, extension = os.path.splitext(name)
+    if not extension:
+        extension = next(iter(guess_all_extensions(type, strict=False)), "")
+    if not extension:
+        extension = ".txt" if type == "message/rfc822" else ".bin"
+    extension = NAME_DROP.sub("", extension)
+
+    name = NAME_PATH.split(name)[-1]
+    name = NAME_DROP.sub("", NAME_HEAD.sub("", name))
+
+    return (name or "attachment") + extension
+
+
 def load_mail_resource(mail: Mail) -> MailResource:
     """Create a Mail resource from the Mail record."""
 
-    message = PARSER.parsebytes(mail.data, headersonly=True)
+    # Each of these resources is created with model_construct() to skip
+    # validation. The data is either from the database or extracted from a
+    # parsed message, so it's already in the shape of the resource.
+    if (headers := mail.headers) is not None:
+        headers = {k: construct_target(v) for k, v in headers.items()}
+    else:
+        headers = load_mail_headers(parse_header(mail.data))
+
+    attachments = [load_attachment_resource(i) for i in mail.attachments]
+
+    return MailResource.model_construct(
+        id=mail.id,
+        date=mail.date,
+        text=mail.text,
+        attachments=attachments,
+        **headers,
+    )
+
+
+def load_attachment_resource(attachment: Attachment) -> AttachmentResource:
+    """Create an Attachment resource from the Attachment record."""
+
+    # The mail_id is only set once the session is flushed so fall back to the
+    # mail of an attachment that's still pending
+    return AttachmentResource.model_construct(
+        mail_id=attachment.mail_id or attachment.mail.id,
+        number=attachment.number,
+        name=attachment.name,
+        type=attachment.type,
+        code=attachment.code,
+    )
+
+
+def construct_target(value: Any) -> Any:
+    """Construct each Target in the JSON serialized header field *value*."""
+
+    if isinstance(value, dict):
+        return Target.model_construct(**value)
+    if isinstance(value, list):
+        return [construct_target(i) for i in value]
+    return value
+
+
+def load_mail_headers(message: EmailMessage) -> dict[str, Any]:
+    """Extract the header fields of a Mail resource from *message*.
+
+    The result is keyed by the Mail resource's field name. A header field
+    absent from *message* is absent from the result.
+    """
+
+    headers: dict[str, Any] = {}
 
     if (from_ := message["From"]) is not None:
-        from_ = unroll(from_)
+        headers["from_"] = unroll(from_)
 
     if (sender := message["Sender"]) is not None:
         sender = sender.address
-        sender = Target(name=sender.display_name, addr_spec=sender.addr_spec)
+        headers["sender"] = Target.model_construct(
+            name=sender.display_name, addr_spec=sender.addr_spec
+        )
 
     if (reply_to := message["Reply-To"]) is not None:
-        reply_to = unroll(reply_to)
+        headers["reply_to"] = unroll(reply_to)
 
     if (to := message["To"]) is not None:
-        to = unroll(to)
+        headers["to"] = unroll(to)
 
     if (cc := message["Cc"]) is not None:
-        cc = unroll(cc)
+        headers["cc"] = unroll(cc)
 
     if (bcc := message["Bcc"]) is not None:
-        bcc = unroll(bcc)
+        headers["bcc"] = unroll(bcc)
 
     if (in_reply_to := message["In-Reply-To"]) is not None:
-        in_reply_to = [email.utils.unquote(i) for i in in_reply_to.split()]
+        headers["in_reply_to"] = unroll_id(in_reply_to)
 
     if (references := message["References"]) is not None:
-        references = [email.utils.unquote(i) for i in references.split()]
+        headers["references"] = unroll_id(references)
 
     if (subject := message["Subject"]) is not None:
-        subject = subject.strip()
+        headers["subject"] = subject.strip()
 
-    attachments = [
-        AttachmentResource.model_validate(attachment, from_attributes=True)
-        for attachment in mail.attachments
-    ]
+    return headers
 
-    return MailResource(
-        id=mail.id,
-        date=mail.date,
-        text=mail.text,
-        from_=from_,
-        sender=sender,
-        reply_to=reply_to,
-        to=to,
-        cc=cc,
-        bcc=bcc,
-        in_reply_to=in_reply_to,
-        references=references,
-        subject=subject,
-        attachments=attachments,
-    )
+
+def parse_header(data: bytes) -> EmailMessage:
+    """Parse the header section of the RFC 5322 email message in *data*."""
+
+    # Even with headersonly=True the parser decodes and consumes the entire
+    # message, so slice the header section off at the first empty line
+    if (m := HEADER_END.search(data)) is not None:
+        data = data[: m.end()]
+    return PARSER.parsebytes(data, headersonly=True)
 
 
 def unroll(header: AddressHeader) -> list[Target]:
     """Unroll the address *header* into a list of addresses."""
 
-    result = []
-    for address in header.addresses:
-        target = Target(name=address.display_name, addr_spec=address.addr_spec)
-        if target not in result:
-            result.append(target)
-    return result
+    # Deduplicate in order before creating each Target
+    unique = dict.fromkeys(
+        (i.display_name, i.addr_spec) for i in header.addresses
+    )
+    return [
+        Target.model_construct(name=name, addr_spec=addr_spec)
+        for name, addr_spec in unique
+    ]
+
+
+def unroll_id(header: str) -> list[str]:
+    """Unroll the msg-id list in *header* into a list of unquoted msg-ids."""
+
+    # This is email.utils.unquote() specialized to the angle brackets of a
+    # msg-id, which matters in a long References header
+    return [
+        i[1:-1] if i[:1] == "<" and i[-1:] == ">" else i for i in header.split()
+    ]
 
 
-def estimate_type(data: bytes | str) -> Optional[tuple[str, str]]:
+def estimate_type(data: bytes | str) -> Optional[tuple[str, Optional[str]]]:
     """Guess the Content-Type and charset of *data*."""
 
+    if isinstance(data, bytes):
+        for signature, type in SIGNATURE:
+            if data.startswith(signature):
+                return (type, "binary")
+
     try:
-        estimate = MAGIC.from_buffer(data)
+        estimate = magic().from_buffer(data)
     except MagicException:
         return None
 
     if estimate is None:
         return None
 
-    header = DEFAULT_POLICY.header_factory("Content-Type", estimate)
-    return (header.content_type, header.params.get("charset"))
+    # libmagic always produces "type/subtype; charset=code" with --mime so
+    # there's no need for the email package's header parser
+    type, _, parameter = estimate.partition(";")
+    key, _, code = parameter.partition("=")
+    if key.strip().lower() != "charset":
+        return (type.strip().lower(), None)
+    return (type.strip().lower(), code.strip().lower())
+
+
+def magic() -> Magic:
+    """Return the current thread's libmagic handle."""
+
+    if (handle := getattr(LOCAL, "magic", None)) is None:
+        handle = LOCAL.magic = Magic(mime=True, mime_encoding=True)
+    return handle
@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import Annotated, Any, Optional
 
 from flask import current_app
-from pydantic import AliasPath, BaseModel, Field, computed_field
+from pydantic import BaseModel, Field, computed_field
 
 
 class Resource(BaseModel, frozen=True, strict=True):
@@ -11,7 +11,7 @@ class Resource(BaseModel, frozen=True, strict=True):
 
 
 class Attachment(Resource, frozen=True):
-    mail_id: str = Field(exclude=True, validation_alias=AliasPath("mail", "id"))
+    mail_id: str = Field(exclude=True)
     number: int
 
     name: Optional[str]
@@ -1,31 +1,37 @@
 from __future__ import annotations
+import base64
 import contextlib
+import functools
+import json
+import math
 import re
+import time
 from datetime import timedelta
 from typing import TYPE_CHECKING, Any, Optional, cast
 
 import jwt
-from flask import Flask, g, jsonify, make_response, request
+from flask import Flask, g, make_response, request, stream_with_context
 from psycopg import Connection, Notify
+from pydantic_core import to_json
 from sqlalchemy import create_engine, delete, func, select, text, update
 from sqlalchemy.orm import (
     Session,
     aliased,
-    contains_eager,
     defer,
     joinedload,
-    lazyload,
     load_only,
+    raiseload,
     scoped_session,
     selectinload,
     sessionmaker,
+    undefer,
 )
-from werkzeug.datastructures import WWWAuthenticate
+from werkzeug.datastructures import MIMEAccept, WWWAuthenticate
+from werkzeug.http import parse_accept_header
 from werkzeug.utils import get_content_type
 
 from archiver.database import Attachment, Consumer, Dispatch, Mail
-from archiver.loader import load_mail_resource
-from archiver.resource import Attachment as AttachmentResource
+from archiver.loader import load_attachment_resource, load_mail_resource
 
 if TYPE_CHECKING:
     from collections.abc import Iterator
@@ -38,6 +44,9 @@ server = Flask(__name__)
 engine = create_engine("postgresql+psycopg:///")
 database = scoped_session(sessionmaker(engine, expire_on_commit=False))
 
+# The format of the "sub" claim in a consumer's bearer token
+SUBJECT = re.compile(r"consumer_id=([0-9]+)")
+
 
 @server.teardown_appcontext
 def remove_database(exception: Optional[BaseException] = None) -> None:
@@ -51,22 +60,24 @@ def authenticate() -> Optional[View]:
     if request.routing_exception is not None:
         return None
 
-    authorization = request.authorization
-    if authorization is None or authorization.type != "bearer":
+    # Split the header by hand rather than have Werkzeug parse it into an
+    # Authorization object as only the bearer scheme is supported.
+    header = request.headers.get("Authorization", "")
+    scheme, _, token = header.partition(" ")
+    if scheme.lower() != "bearer":
         return reject()
 
-    if not (token := authorization.token):
+    if not (token := token.strip()):
         return reject(error="invalid_request")
 
-    secret = server.secret_key
-    try:
-        data = jwt.decode(
-            token, secret, algorithms=["HS256"], options={"require": ["sub"]}
-        )
-    except jwt.exceptions.InvalidTokenError:
+    # Reject a token signed with another algorithm before verifying it
+    if (
+        token_algorithm(token.partition(".")[0]) != "HS256"
+        or (data := decode(token, server.secret_key)) is None
+    ):
         return reject(error="invalid_token")
 
-    if not (m := re.match(r"^consumer_id=([0-9]+)$", data["sub"])):
+    if not (m := SUBJECT.fullmatch(data["sub"])):
         return reject(error="invalid_token")
 
     if (consumer := database.get(Consumer, int(m.group(1)))) is None:
@@ -75,6 +86,76 @@ def authenticate() -> Optional[View]:
     g.consumer = consumer
 
 
+def decode(token: str, secret: str | bytes | None) -> Optional[dict[str, Any]]:
+    """Decode and verify the bearer *token*, or return None if it's invalid."""
+
+    if (verified := verify(token, secret)) is None:
+        return None
+
+    # The time claims are checked on each request as the verification is cached
+    data, start, end = verified
+    return data if start <= time.time() < end else None
+
+
+@functools.lru_cache(maxsize=1024)
+def verify(
+    token: str, secret: str | bytes | None
+) -> Optional[tuple[dict[str, Any], float, float]]:
+    """Verify the bearer *token* except for its time claims.
+
+    Return its claims and the period it's valid in according to its nbf, iat,
+    and exp claims, or None if it's invalid. This is cached so that a client
+    reusing its token isn't verified on each request. The *secret* is part of
+    the key so that a new secret key takes effect immediately.
+    """
+
+    # Defer the time claims to decode() but still reject one that isn't an
+    # integer like PyJWT would
+    try:
+        data = jwt.decode(
+            token,
+            secret,
+            algorithms=["HS256"],
+            options={
+                "require": ["sub"],
+                "verify_exp": False,
+                "verify_iat": False,
+                "verify_nbf": False,
+            },
+        )
+    except jwt.exceptions.InvalidTokenError:
+        return None
+
+    try:
+        start = max(
+            (int(data[k]) for k in ("nbf", "iat") if k in data),
+            default=-math.inf,
+        )
+        end = int(data["exp"]) if "exp" in data else math.inf
+    except (OverflowError, TypeError, ValueError):
+        return None
+
+    return (data, start, end)
+
+
+@functools.lru_cache(maxsize=4096)
+def token_algorithm(header: str) -> Optional[str]:
+    """Return the algorithm named in the encoded JWT *header* if any.
+
+    A client's tokens tend to share a header so this is cached to reject a
+    token with the wrong algorithm without decoding each one.
+    """
+
+    padding = "=" * (-len(header) % 4)
+    try:
+        data = json.loads(base64.urlsafe_b64decode(header + padding))
+    except ValueError:
+        return None
+
+    alg = data.get("alg") if isinstance(data, dict) else None
+    return alg if isinstance(alg, str) else None
+
+
 def reject(**kwargs: str | None) -> View:
     """Return 401 with a custom WWW-Authenticate header."""
 
@@ -84,15 +165,32 @@ def reject(**kwargs: str | None) -> View:
     return r
 
 
+@functools.lru_cache(maxsize=256)
+def parse_accept(header: str) -> MIMEAccept:
+    """Parse the Accept *header* into a MIMEAccept."""
+    return parse_accept_header(header, MIMEAccept)
+
+
+@functools.lru_cache(maxsize=1024)
+def negotiate(header: str, mime: tuple[str, ...]) -> Optional[str]:
+    """Return the best of the *mime* types for the Accept *header*.
+
+    This is JSON when the *header* is empty and None when none of the *mime*
+    types are acceptable. Clients tend to send the same Accept header on each
+    request so the result is cached.
+    """
+
+    if not (accept := parse_accept(header)):
+        return "application/json"
+    return accept.best_match(mime)
+
+
 @server.route("/mail/<string:id>", methods=["GET"])
 def retrieve_mail(id: str) -> View:
     """Retrieve the mail identified by *id*."""
 
     mime = ("text/plain", "application/json", "message/rfc822")
-    if request.accept_mimetypes:
-        mimetype = request.accept_mimetypes.best_match(mime)
-    else:
-        mimetype = "application/json"
+    mimetype = negotiate(request.headers.get("Accept", ""), mime)
 
     if mimetype in ("text/plain", "message/rfc822"):
         return retrieve_mail_as_text(id, mimetype)
@@ -100,10 +198,7 @@ def retrieve_mail(id: str) -> View:
     if mimetype == "application/json":
         return retrieve_mail_as_json(id)
 
-    stmt = Mail.consumer_select(g.consumer).filter_by(id=id)
-    if not database.scalar(select(stmt.exists())):
-        return "Not Found", 404
-
+    # This is returned whether or not the mail exists to save a query
     return "Not Acceptable", 406
 
 
@@ -115,20 +210,27 @@ def retrieve_mail_as_text(id: str, mimetype: str) -> View:
     if (mail := database.scalars(stmt).one_or_none()) is None:
         return "Not Found", 404
 
-    data = mail.data.decode("utf-8")
-    return server.response_class(data, mimetype=mimetype)
+    # Return the message as it's stored. Decoding it would only have the
+    # response encode it again.
+    return server.response_class(mail.data, mimetype=mimetype)
 
 
 def retrieve_mail_as_json(id: str) -> View:
     """Retrieve the mail identified by *id* as JSON."""
 
+    # Mail.data is only needed if Mail.headers is NULL, in which case it's
+    # loaded on demand
     stmt = Mail.consumer_select(g.consumer).filter_by(id=id)
-    stmt = stmt.options(joinedload(Mail.attachments))
-    if (mail := database.scalars(stmt).unique().one_or_none()) is None:
+    stmt = stmt.options(load_only(Mail.id, Mail.date, Mail.text, Mail.headers))
+    stmt = stmt.options(
+        selectinload(Mail.attachments), raiseload("*", sql_only=True)
+    )
+    if (mail := database.scalars(stmt).one_or_none()) is None:
         return "Not Found", 404
 
     resource = load_mail_resource(mail)
-    return resource.model_dump(mode="json", by_alias=True)
+    data = to_json(resource, by_alias=True)
+    return server.response_class(data, mimetype="application/json")
 
 
 @server.route("/mail/<string:id>", methods=["DELETE"])
@@ -157,9 +259,19 @@ def retrieve_attachment(mail_id: str, number: int) -> View:
         .join(Mail.attachments)
         .filter_by(number=number)
         .with_for_update(of=Attachment, read=True)
-        .options(contains_eager(Attachment.mail))
-        .options(defer(Attachment.data))
+        .options(raiseload("*", sql_only=True))
     )
+
+    # Of the attachment's representations only JSON doesn't need its data. As
+    # its type isn't known yet, predict whether it'll be selected from the
+    # Accept header: unless the client prefers JSON, load the data in this
+    # SELECT rather than in a second one when it's accessed.
+    accept = parse_accept(request.headers.get("Accept", ""))
+    if not accept or accept.best == "application/json":
+        stmt = stmt.options(defer(Attachment.data))
+    else:
+        stmt = stmt.options(undefer(Attachment.data))
+
     if (attachment := database.scalars(stmt).one_or_none()) is None:
         return "Not Found", 404
 
@@ -168,10 +280,7 @@ def retrieve_attachment(mail_id: str, number: int) -> View:
         mime = (*mime, "text/plain")
     mime = (*mime, "application/octet-stream")
 
-    if request.accept_mimetypes:
-        mimetype = request.accept_mimetypes.best_match(mime)
-    else:
-        mimetype = "application/json"
+    mimetype = negotiate(request.headers.get("Accept", ""), mime)
 
     if mimetype == attachment.type:
         return retrieve_attachment_as_native(attachment)
@@ -213,10 +322,9 @@ def retrieve_attachment_as_native(attachment: Attachment) -> View:
 def retrieve_attachment_as_json(attachment: Attachment) -> View:
     """Return the *attachment* as JSON."""
 
-    resource = AttachmentResource.model_validate(
-        attachment, from_attributes=True
-    )
-    return resource.model_dump(mode="json", by_alias=True)
+    resource = load_attachment_resource(attachment)
+    data = to_json(resource, by_alias=True)
+    return server.response_class(data, mimetype="application/json")
 
 
 def retrieve_attachment_as_byte(attachment: Attachment) -> View:
@@ -232,10 +340,7 @@ def select_mail() -> View:
     """Update and return or stream dispatches relevant to the consumer."""
 
     mime = ("application/json", "application/x-ndjson")
-    if request.accept_mimetypes:
-        mimetype = request.accept_mimetypes.best_match(mime)
-    else:
-        mimetype = "application/json"
+    mimetype = negotiate(request.headers.get("Accept", ""), mime)
 
     if mimetype == "application/json":
         return select_mail_as_json()
@@ -268,17 +373,32 @@ def select_mail_as_json() -> View:
     # Load each attachment with a SELECT ... IN ... load. Take a FOR KEY SHARE
     # lock on mail to ensure that the attachment load is consistent.
     stmt = stmt.with_for_update(of=Mail, read=True, key_share=True)
-    stmt = stmt.options(selectinload(Mail.attachments))
+    stmt = stmt.options(
+        selectinload(Mail.attachments), raiseload("*", sql_only=True)
+    )
 
     result = [load_mail_resource(mail) for mail in database.scalars(stmt)]
     database.commit()
 
-    return jsonify([i.model_dump(mode="json", by_alias=True) for i in result])
+    # Serialize each resource as it's sent rather than building a list of
+    # dicts and then the entire JSON array in memory. This can't stream the
+    # selection itself: PostgreSQL doesn't allow a server-side cursor on a
+    # data-modifying CTE.
+    def generate() -> Iterator[bytes]:
+        yield b"["
+        for i, resource in enumerate(result):
+            if i > 0:
+                yield b","
+            yield to_json(resource, by_alias=True)
+        yield b"]"
+
+    body = stream_with_context(generate())
+    return server.response_class(body, mimetype="application/json")
 
 
 def stream_mail(
     consumer_id: int, environment: Optional[WSGIEnvironment] = None
-) -> Iterator[str]:
+) -> Iterator[bytes]:
     """Update and stream dispatches relevant to the consumer as JSON."""
 
     # Used to serialize "self" in MailResource and AttachmentResource
@@ -333,8 +453,14 @@ def stream_mail(
             select(Dispatch)
             .filter_by(consumer_id=consumer_id)
             .where(Dispatch.next_time <= func.now())
-            .with_for_update(key_share=True)
-            .options(lazyload(Dispatch.mail).joinedload(Mail.attachments))
+            .with_for_update(of=Dispatch, key_share=True)
+            .options(
+                joinedload(Dispatch.mail, innerjoin=True).options(
+                    load_only(Mail.id, Mail.date, Mail.text, Mail.headers),
+                    selectinload(Mail.attachments),
+                ),
+                raiseload("*", sql_only=True),
+            )
         )
 
         while True:
@@ -356,7 +482,7 @@ def stream_mail(
                 database.commit()
 
                 with dump_context:
-                    yield f"{resource.model_dump_json(by_alias=True)}\n"
+                    yield to_json(resource, by_alias=True) + b"\n"
             database.rollback()
 
             stream_mail_test_hook()
@@ -367,8 +493,8 @@ def stream_mail(
                 # If we can't locate a dispatch for the notified mail, then
                 # assume that we handled it earlier.
                 if (dispatch := database.scalar(stmt)) is None:
+                    database.rollback()
                     continue
-                database.rollback()
 
                 dispatch.last_time = func.now()
                 dispatch.next_time = func.now() + timedelta(hours=1)
@@ -376,7 +502,7 @@ def stream_mail(
                 database.commit()
 
                 with dump_context:
-                    yield f"{resource.model_dump_json(by_alias=True)}\n"
+                    yield to_json(resource, by_alias=True) + b"\n"
 
 
 def stream_mail_test_hook() -> None:
@@ -17,7 +17,12 @@ CREATE TABLE mail (
   text TEXT NOT NULL,
 
   -- The literal email message as received
-  data BYTEA NOT NULL
+  data BYTEA NOT NULL,
+
+  -- The header fields of the email message that are reported in the Mail
+  -- resource, extracted when the email message is received. If this is
+  -- ``NULL`` then they're extracted from `data` on demand.
+  headers JSONB
 );
 
 CREATE TABLE attachment (
@@ -84,6 +89,10 @@ CREATE TABLE dispatch (
   created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
+-- Each consumer's dispatches are selected in order of `next_time`, up to the
+-- current time
+CREATE INDEX dispatch_consumer_next_time ON dispatch (consumer_id, next_time);
+
 CREATE FUNCTION dispatch_notify() RETURNS TRIGGER AS $$
 BEGIN
   PERFORM pg_notify('consumer_id=' || NEW.consumer_id, NEW.mail_id);
@@ -1,3 +1,4 @@
+import glob
 import logging
 import os
 import uuid
@@ -59,11 +60,19 @@ def session() -> Iterator[Session]:
         yield session
 
 
+@pytest.fixture(scope="session")
+def eml_corpus() -> dict[str, bytes]:
+    result = {}
+    for path in glob.glob(os.path.join(ROOT, "*.eml")):
+        with open(path, "rb") as f:
+            result[os.path.basename(path).removesuffix(".eml")] = f.read()
+    return result
+
+
 @pytest.fixture
-def mail(session: Session) -> Mail:
+def mail(session: Session, eml_corpus: dict[str, bytes]) -> Mail:
     mail_id = uuid.uuid4().hex.encode("ascii")
-    with open(os.path.join(ROOT, "sample.eml"), "rb") as f:
-        data = f.read()
+    data = eml_corpus["sample"]
     data = data.replace(b"xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx", mail_id)
     session.add(mail := load_mail_record(data))
     session.commit()
@@ -6,7 +6,7 @@ from archiver.database import Attachment, Consumer, Dispatch, Mail
 def test_mail(session):
     mail = Mail(id="test-mail", date=func.now(), text="", data=b"")
     session.add(mail)
-    session.commit()
+    session.flush()
 
 
 def test_attachment(session, mail):
@@ -14,20 +14,22 @@ def test_attachment(session, mail):
         mail=mail, number=10, type="text/plain", data=b"asdf"
     )
     session.add(attachment)
-    session.commit()
+    session.flush()
+
+    assert repr(attachment) == f"Attachment<{mail.id}#10>"
 
 
 def test_consumer(session):
     consumer = Consumer(name="test-consumer")
     session.add(consumer)
-    session.commit()
+    session.flush()
 
 
 def test_dispatch(session, consumer, mail):
     dispatch = Dispatch(consumer=consumer, mail=mail)
     session.add(dispatch)
     now = session.scalar(select(func.now()))
-    session.commit()
+    session.flush()
 
     assert now == dispatch.next_time
     assert now == dispatch.created_at
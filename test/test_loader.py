@@ -1,18 +1,15 @@
-import os.path
 from datetime import datetime, timedelta, timezone
 from textwrap import dedent
 
 from archiver.loader import load_mail_record, load_mail_resource
 
-ROOT = os.path.dirname(__file__)
 DATE = datetime(2024, 6, 10, 8, 0, 0, tzinfo=timezone(timedelta(hours=-4)))
 
 
-def test_load_1(session):
-    with open(os.path.join(ROOT, "1.eml"), "rb") as f:
-        data = f.read()
+def test_load_1(session, eml_corpus):
+    data = eml_corpus["1"]
     session.add(record := load_mail_record(data))
-    session.commit()
+    session.flush()
 
     assert record.id == "12b13e25-5ee2-471c-b78c-e3178668864d@kaimel.io"
     assert record.date == DATE
@@ -82,11 +79,10 @@ def test_load_1(session):
         assert a.type == b.type
 
 
-def test_load_2(session):
-    with open(os.path.join(ROOT, "2.eml"), "rb") as f:
-        data = f.read()
+def test_load_2(session, eml_corpus):
+    data = eml_corpus["2"]
     session.add(record := load_mail_record(data))
-    session.commit()
+    session.flush()
 
     assert record.id == "30da3ae3-f1f1-44a4-966a-073eb75e1b70@kaimel.io"
     assert record.date == DATE
@@ -124,11 +120,10 @@ def test_load_2(session):
         assert a.type == b.type
 
 
-def test_load_3(session):
-    with open(os.path.join(ROOT, "3.eml"), "rb") as f:
-        data = f.read()
+def test_load_3(session, eml_corpus):
+    data = eml_corpus["3"]
     session.add(record := load_mail_record(data))
-    session.commit()
+    session.flush()
 
     assert record.id == "aa9451e1-e155-4f01-b765-db7a3b99f153@kaimel.io"
     assert record.date == DATE
@@ -152,11 +147,10 @@ def test_load_3(session):
     assert resource.attachments == []
 
 
-def test_load_4(session):
-    with open(os.path.join(ROOT, "4.eml"), "rb") as f:
-        data = f.read()
+def test_load_4(session, eml_corpus):
+    data = eml_corpus["4"]
     session.add(record := load_mail_record(data))
-    session.commit()
+    session.flush()
 
     assert record.id == "39669c1f-692f-467c-a0cd-f51a13e1fe12@kaimel.io"
     assert record.date == DATE
@@ -204,3 +198,40 @@ def test_load_4(session):
         assert a.number == b.number
         assert a.name == b.name
         assert a.type == b.type
+
+
+def test_load_5(session, eml_corpus):
+    data = eml_corpus["5"]
+    session.add(record := load_mail_record(data))
+    session.flush()
+
+    assert record.id == "5e0c2f4a-3d1b-4c8e-9f7a-2b6d8e1c4a90@kaimel.io"
+    assert record.text == "This is some *sample* text"
+    assert len(record.attachments) == 2
+
+    # A text attachment is decoded with its declared charset and stored as UTF-8
+    attachment = record.attachments[0]
+    assert attachment.number == 2
+    assert attachment.name == "quote.txt"
+    assert attachment.type == "text/plain"
+    assert attachment.code == "utf-8"
+    assert attachment.data.strip() == "He said \u201chello\u201d".encode()
+
+    # Without a declared charset an undecodable attachment is stored as is
+    attachment = record.attachments[1]
+    assert attachment.number == 3
+    assert attachment.name == "unknown.txt"
+    assert attachment.type == "text/plain"
+    assert attachment.data.strip() == b"He said \x93hello\x94"
+
+
+def test_load_headers(eml_corpus):
+    record = load_mail_record(eml_corpus["1"])
+    assert record.headers is not None
+
+    # A record without cached headers extracts them from its data on demand
+    resource = load_mail_resource(record)
+    for attachment in resource.attachments:
+        assert attachment.mail_id == record.id
+    record.headers = None
+    assert load_mail_resource(record) == resource
@@ -1,4 +1,5 @@
 import json
+import time
 
 import jwt
 from sqlalchemy import func
@@ -66,6 +67,31 @@ def test_authentication(server, client, consumer):
     assert r.status_code == 403
 
 
+def test_authentication_time(server, client, consumer, monkeypatch):
+    client.authorization = None
+
+    data = {"sub": f"consumer_id={consumer.id}"}
+    secret = server.secret_key
+
+    # The time claims are checked even once the token is verified
+    now = time.time()
+    code = jwt.encode({**data, "exp": int(now) + 5}, secret, algorithm="HS256")
+    r = client.get("/mail/none", headers={"Authorization": f"Bearer {code}"})
+    assert r.status_code == 404
+    monkeypatch.setattr(time, "time", lambda: now + 10)
+    r = client.get("/mail/none", headers={"Authorization": f"Bearer {code}"})
+    assert r.status_code == 401
+    assert r.www_authenticate.error == "invalid_token"
+
+    code = jwt.encode({**data, "nbf": int(now) + 5}, secret, algorithm="HS256")
+    monkeypatch.setattr(time, "time", lambda: now)
+    r = client.get("/mail/none", headers={"Authorization": f"Bearer {code}"})
+    assert r.status_code == 401
+    monkeypatch.setattr(time, "time", lambda: now + 10)
+    r = client.get("/mail/none", headers={"Authorization": f"Bearer {code}"})
+    assert r.status_code == 404
+
+
 def test_retrieve_mail_absent(client):
     assert client.get("/mail/none").status_code == 404
 
@@ -77,7 +103,7 @@ def test_retrieve_mail_accept_none(client, session, mail, dispatch):
     session.delete(dispatch)
     session.commit()
     r = client.get(f"/mail/{mail.id}", headers={"Accept": "none/plain"})
-    assert r.status_code == 404
+    assert r.status_code == 406
 
 
 def test_retrieve_mail_accept_text(client, session, mail, dispatch):